@@ -1,14 +1,22 @@
 """Save data obtained from MQTT broker."""
 
+import collections
 import csv
+import functools
+import gzip
 import pathlib
 import json
 import queue
+import re
 import threading
 import time
 import math
-import uuid
+import hashlib
 import hmac
+import tempfile
+import shutil
+import signal
+import socket
 
 import logging
 
@@ -20,13 +28,57 @@ except ImportError:
 
 from datetime import datetime
 
+# for checking the open file limit if we can
+try:
+    import resource
+except ImportError:
+    pass
+
+# for faster MQTT payload (de)serialisation if we can
+try:
+    from orjson import loads as _fast_loads, dumps as payload_dumps
+
+    def payload_loads(payload):
+        """Parse a JSON MQTT payload, with orjson where it can cope.
+
+        Parameters
+        ----------
+        payload : bytes
+            MQTT message payload.
+
+        Returns
+        -------
+        object
+            Parsed payload.
+        """
+        try:
+            return _fast_loads(payload)
+        except json.JSONDecodeError:
+            # orjson rejects the NaN and Infinity that python's json module writes by default
+            return json.loads(payload)
+
+except ImportError:
+    from json import loads as payload_loads, dumps as payload_dumps
+
 try:
     from centralcontrol.put_ftp import put_ftp
 except ImportError:
     pass
 
+# for compressing files before FTP backup if we can
+try:
+    import zstandard
+except ImportError:
+    pass
+
 import paho.mqtt.client as mqtt
 import yaml
+
+# for libyaml accelerated yaml writing if we can
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
 import os
 import sys
 
@@ -36,8 +88,47 @@ import argparse
 class Saver(object):
     ftp_env_var = "SAVER_FTP"
     hk = "gosox".encode()
-
-    def __init__(self, mqtt_host="127.0.0.1", ftp_uri=None):
+    max_queued = 10000  # most received messages to hold before applying back-pressure
+    behind_queued = 8000  # queue length at which operators get warned the saver is falling behind
+    caught_up_queued = 5000  # queue length below which the saver counts as keeping up again
+    max_batch = 64  # most queued messages to handle before flushing data files
+    max_open_files = 64  # most data files to keep open at once
+    flush_interval = 1.0  # longest time in seconds buffered data waits under sustained load
+    max_backup_retry_delay = 61  # longest wait in seconds between FTP backup attempts
+    issue_log_interval = 100  # repeats of the same save issue between warnings about it
+    disk_error_backoff = 1.0  # time in seconds the save thread waits after a file system error
+    ftp_workers = 4  # most FTP connections to upload backups over at once
+
+    # header strings
+    eqe_header_items = [
+        "timestamp (s)",
+        "wavelength (nm)",
+        "X (V)",
+        "Y (V)",
+        "Aux In 1 (V)",
+        "Aux In 2 (V)",
+        "Aux In 3 (V)",
+        "Aux In 4 (V)",
+        "R (V)",
+        "Phase (deg)",
+        "Freq (Hz)",
+        "Ch1 display",
+        "Ch2 display",
+    ]
+    eqe_header = "\t".join(eqe_header_items) + "\n"
+
+    iv_header = "voltage (V)\tcurrent (A)\ttime (s)\tstatus\n"
+
+    spectrum_cal_header = "wls (nm)\traw (counts)\n"
+
+    psu_cal_header = iv_header[:-1] + "\tset_psu_current (A)\n"
+
+    daq_header = "timestamp (s)\tT (degC)\tIntensity (V)\n"
+
+    # data file headers by measurement kind, anything else is iv-like
+    data_headers = {"eqe": eqe_header, "daq": daq_header}
+
+    def __init__(self, mqtt_host="127.0.0.1", ftp_uri=None, ftp_compress=False):
 
         self.outq = queue.Queue()
 
@@ -73,41 +164,33 @@ class Saver(object):
         self.mqtt_host = mqtt_host
         self.ftp_uri = ftp_uri
 
-        # make header strings
-        eqe_header_items = [
-            "timestamp (s)",
-            "wavelength (nm)",
-            "X (V)",
-            "Y (V)",
-            "Aux In 1 (V)",
-            "Aux In 2 (V)",
-            "Aux In 3 (V)",
-            "Aux In 4 (V)",
-            "R (V)",
-            "Phase (deg)",
-            "Freq (Hz)",
-            "Ch1 display",
-            "Ch2 display",
-        ]
-        self.eqe_header = "\t".join(eqe_header_items) + "\n"
-
-        self.iv_header = "voltage (V)\tcurrent (A)\ttime (s)\tstatus\n"
-
-        self.spectrum_cal_header = "wls (nm)\traw (counts)\n"
-
-        self.psu_cal_header = self.iv_header[:-1] + "\tset_psu_current (A)\n"
-
-        self.daq_header = "timestamp (s)\tT (degC)\tIntensity (V)\n"
-
         # event for when we should start processing the backup queue
         self.trigger_backup = threading.Event()
 
         # add incoming mqtt messages to a queue for worker thread
-        self.save_queue = queue.SimpleQueue()
+        # bounded so a stalled disk pushes back on the broker instead of eating all our memory
+        self.save_queue = queue.Queue(maxsize=self.max_queued)
+        self.falling_behind = False
+        self.save_queue_blocked = False
 
         self.folder = None
         self.exp_timestamp = None
 
+        # open data files with their paths, keyed by (device, measurement)
+        self.file_cache = collections.OrderedDict()
+
+        # keep the cache well clear of the process's open file limit
+        if "resource" in sys.modules:
+            soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft_limit != resource.RLIM_INFINITY:
+                self.max_open_files = max(1, min(self.max_open_files, soft_limit - 32))
+
+        # next free liv/div file number, keyed by (device, measurement)
+        self.sweep_counters = {}
+
+        # how many times each message handling problem has come up this run
+        self.save_issues = collections.Counter()
+
         if "centralcontrol.put_ftp" in sys.modules:
             # queue latest file names for optional FTP backup in worker thread
             self.backup_q = queue.SimpleQueue()
@@ -115,20 +198,60 @@ class Saver(object):
             self.backup_q = None
             self.lg.debug("FTP backup support missing.")
 
-        # create mqtt client id
-        self.client_id = f"saver-{uuid.uuid4().hex}"
+        # optionally compress files on their way to the FTP backup, with zstd if we can or gzip otherwise
+        self.ftp_compress = ftp_compress
+        if self.ftp_compress and ("zstandard" not in sys.modules):
+            self.lg.debug("zstd support missing, FTP backups will be gzip compressed.")
+
+        # create mqtt client id, the same each time this saver starts so it picks up its own broker session again
+        whereami = f"{socket.gethostname()}:{os.getcwd()}".encode()
+        self.client_id = f"saver-{hashlib.sha1(whereami).hexdigest()[:16]}"
 
         # setup mqttclient and callbacks
-        self.mqttc = mqtt.Client(self.client_id)
-        self.mqttc.will_set("saver/status", json.dumps(f"{self.client_id} offline"), 2, retain=True)
+        # keep our session on the broker so it holds messages for us if it drops us while we're falling behind
+        self.mqttc = mqtt.Client(self.client_id, clean_session=False)
+        self.mqttc.will_set("saver/status", payload_dumps(f"{self.client_id} offline"), 2, retain=True)
         self.mqttc.on_message = self.on_message
         self.mqttc.on_connect = self.on_connect
         self.mqttc.on_disconnect = self.on_disconnect
 
+        # keyed run data hasher, copied for each check to skip redoing the key setup
+        self.run_mac = hmac.new(self.hk, digestmod="sha1")
+
+        # what to do with each kind of incoming message
+        self.topic_handlers = {
+            "data": self.handle_data,
+            "calibration": self.handle_calibration,
+            "measurement/run": self.handle_run,
+            "measurement/log": self.handle_log,
+        }
+
     # send up a log message to the status channel
     def send_log_msg(self, record):
-        payload = {"level": record.levelno, "msg": record.msg}
-        self.outq.put({"topic": "measurement/log", "payload": json.dumps(payload), "qos": 2})
+        payload = {"level": record.levelno, "msg": record.getMessage()}
+        self.outq.put({"topic": "measurement/log", "payload": payload_dumps(payload), "qos": 2})
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def parse_kind(kind):
+        """Work out the file extension for a measurement kind.
+
+        Parameters
+        ----------
+        kind : str
+            Measurement kind, e.g. eqe_measurement etc.
+
+        Returns
+        -------
+        exp : str
+            File extension, without any iv sweep type prefix.
+        iv : bool
+            Whether this is an iv measurement that needs a sweep type prefix.
+        """
+        iv = kind.startswith("iv_measurement")
+        if iv:
+            kind = kind.split("/")[0]
+        return kind.replace("_measurement", ""), iv
 
     def save_data(self, payload, kind):
         """Save data to text file.
@@ -141,12 +264,9 @@ class Saver(object):
             Measurement kind, e.g. eqe_measurement etc.
         """
         # create file extension, adding prefix for type of iv measurement if applicable
-        if kind.startswith("iv_measurement"):
-            exp_prefix = payload["sweep"][0]
-            kind = kind.split("/")[0]
-        else:
-            exp_prefix = ""
-        exp = f"{exp_prefix}{kind.replace('_measurement', '')}"
+        exp, iv = self.parse_kind(kind)
+        if iv:
+            exp = f'{payload["sweep"][0]}{exp}'
 
         # handle missing timestamp
         if self.exp_timestamp is None:
@@ -162,13 +282,14 @@ class Saver(object):
             self.lg.warning("Possibly because of a missed run start message")
             self.lg.warning(f"New target folder configured: {self.folder}")
 
-        if self.folder.exists() == False:
+        if not self.folder.exists():
             self.lg.warning(f"Target data folder does not exist: {self.folder}")
             self.lg.warning("That could mean the data folder was disappeared mid-run or it wasn't created properly on run start")
             self.lg.warning("Regenerating that folder now")
+            self.close_files()  # any open handles point into the vanished folder
             self.folder.mkdir(parents=True, exist_ok=False)
 
-        save_folder = self.folder
+        save_folder = os.fspath(self.folder)
 
         file_prefix = ""
 
@@ -185,58 +306,130 @@ class Saver(object):
                 idn = "_".join(joinup)
         except Exception as e:
             idn = "unknown_deviceX"
-            self.lg.debug(f"Payload parse error: {e}")
-            self.lg.debug(f"Using {idn=}")
+            self.lg.debug("Payload parse error: %s", e)
+            self.lg.debug("Using idn=%r", idn)
 
         # define a format to use for the file name
         save_path_format = "{file_prefix}{idn}_{timestamp}.{exp}.tsv"
 
-        # automatically increment iv scan extension
-        if exp.startswith("liv") or exp.startswith("div"):
-            i = 1
-            while True:
-                test_exp = f"{exp}{i}"
+        sweep = exp.startswith("liv") or exp.startswith("div")
 
-                test_name = save_path_format.format(file_prefix=file_prefix, idn=idn, timestamp=self.exp_timestamp, exp=test_exp)
+        if payload["data"] == []:
+            self.lg.debug("EMPTY PAYLOAD")
 
-                if save_folder.joinpath(test_name).exists():
+        if sweep:
+            # automatically increment iv scan extension
+            i = self.sweep_counters.get((idn, exp))
+            if i is None:
+                # first sweep of this kind for this device since we (re)started, so look once for earlier ones
+                name_start = save_path_format.format(file_prefix=file_prefix, idn=idn, timestamp=self.exp_timestamp, exp=exp)[: -len(".tsv")]
+                pattern = re.compile(re.escape(name_start) + r"(\d+)\.tsv")
+                i = 1
+                with os.scandir(save_folder) as it:
+                    for entry in it:
+                        match = pattern.fullmatch(entry.name)
+                        if match:
+                            i = max(i, int(match.group(1)) + 1)
+            # each sweep is written in one go to a file of its own, with the header row sent along with the data.
+            # get that ready first so a bad payload doesn't leave an empty file using up a sweep number.
+            data = (self.data_headers.get(exp, self.iv_header) + self.format_rows(payload["data"])).encode()
+
+            # claim the next file name atomically, stepping past any that turned up behind our back
+            while True:
+                save_path = os.path.join(save_folder, save_path_format.format(file_prefix=file_prefix, idn=idn, timestamp=self.exp_timestamp, exp=f"{exp}{i}"))
+                try:
+                    fd = os.open(save_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                except FileExistsError:
                     i = i + 1
                 else:
-                    exp = test_exp
                     break
+            self.sweep_counters[(idn, exp)] = i + 1
+            exp = f"{exp}{i}"
 
-        # build save path
-        save_path = save_folder.joinpath(save_path_format.format(file_prefix=file_prefix, idn=idn, timestamp=self.exp_timestamp, exp=exp))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            new_file = True
+            single_row = False
+        else:
+            cached = self.file_cache.get((idn, exp))
+            if cached is not None:
+                # this (device, measurement) stream already has a file open
+                save_path, f = cached
+                self.file_cache.move_to_end((idn, exp))
+                new_file = False
+            else:
+                # build save path
+                save_path = os.path.join(save_folder, save_path_format.format(file_prefix=file_prefix, idn=idn, timestamp=self.exp_timestamp, exp=exp))
+
+                # stay within our open file budget by closing the least recently used one
+                if len(self.file_cache) >= self.max_open_files:
+                    key, (old_path, old_f) = self.file_cache.popitem(last=False)
+                    try:
+                        old_f.close()
+                    except Exception as e:
+                        self.report_save_issue(e, f"Problem closing {old_path}")
+
+                # keep the file open for the rest of the stream, a fresh one gets just a header row first
+                f = open(save_path, "a", buffering=1 << 16, newline="\n")
+                new_file = f.tell() == 0
+                if new_file:
+                    f.writelines(self.data_headers.get(exp, self.iv_header))
+                self.file_cache[(idn, exp)] = (save_path, f)
+
+            # append the data to file
+            f.write(self.format_rows(payload["data"][:1]))
+            single_row = True
 
-        new_file = not save_path.exists()
+        if (new_file) and (self.ftp_uri is not None) and (self.backup_q):
+            self.backup_q.put(pathlib.Path(save_path))  # append file name for backup
+            if single_row and self.trigger_backup.is_set():
+                self.lg.warning(f"It's possible an unfinished file was added to the backup queue during active backup task: {save_path}")
 
-        # create the data file with just a header row
-        if new_file:
-            with open(save_path, "x", newline="\n") as f:
-                if exp == "eqe":
-                    f.writelines(self.eqe_header)
-                elif exp == "daq":
-                    f.writelines(self.daq_header)
-                else:
-                    f.writelines(self.iv_header)
+    def format_rows(self, rows):
+        """Format numeric data rows as one block of tab separated text.
 
-        if payload["data"] == []:
-            self.lg.debug("EMPTY PAYLOAD")
+        Parameters
+        ----------
+        rows : list of list
+            Data rows.
 
-        # append the data to file
-        with open(save_path, "a", newline="\n") as f:
-            writer = csv.writer(f, delimiter="\t")
-            if exp.startswith("liv") or exp.startswith("div"):
-                writer.writerows(payload["data"])
-                single_row = False
-            else:
-                writer.writerow(payload["data"][0])
-                single_row = True
+        Returns
+        -------
+        str
+            TSV lines, terminated and with empty cells for None just as csv.writer wrote them.
+        """
+        return "".join(["\t".join(["" if x is None else str(x) for x in row]) + "\r\n" for row in rows])
 
-        if (new_file) and (self.ftp_uri is not None) and (self.backup_q):
-            self.backup_q.put(save_path)  # append file name for backup
-            if (single_row == True) and self.trigger_backup.is_set():
-                self.lg.warning(f"It's possible an unfinished file was added to the backup queue during active backup task: {save_path}")
+    def flush_files(self):
+        """Flush buffered data in all open data files to disk."""
+        for save_path, f in self.file_cache.values():
+            try:
+                f.flush()
+            except Exception as e:
+                self.report_save_issue(e, f"Problem flushing {save_path}")
+
+    def close_files(self, sync=False):
+        """Flush and close all open data files and forget sweep file numbering.
+
+        Parameters
+        ----------
+        sync : bool
+            Also make sure the data has reached the disk before closing.
+        """
+        self.sweep_counters.clear()
+        while self.file_cache:
+            key, (save_path, f) = self.file_cache.popitem()
+            # buffered rows only reach the disk here, so make sure a failure gets noticed
+            try:
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                self.lg.warning(f"Problem syncing {save_path}: {e}")
+            try:
+                f.close()
+            except Exception as e:
+                self.lg.warning(f"Problem closing {save_path}: {e}")
 
     def save_calibration(self, payload, kind, extra=None):
         """Save calibration data.
@@ -292,19 +485,20 @@ class Saver(object):
             save_path = save_folder.joinpath(f"{human_timestamp}_{idn}.{kind}.cal.tsv")
             header = None
 
-        if good_kind == True:
-            if save_path.exists() == False:
-                if header:
-                    with open(save_path, "x", newline="\n") as f:
+        if good_kind:
+            try:
+                # exclusive create, so an existing cal file is never touched
+                with open(save_path, "x", newline="\n") as f:
+                    if header:
                         f.writelines(header)
-                with open(save_path, "a", newline="\n") as f:
                     writer = csv.writer(f, delimiter="\t")
                     writer.writerows(data)
+            except FileExistsError:
+                self.lg.debug(f"Not saving cal data because a file for it already exists: {save_path=}")
+            else:
                 if (self.ftp_uri) and (self.backup_q):
                     # trigger FTP backup of cal file
                     self.backup_q.put(save_path)
-            else:
-                self.lg.debug(f"Not saving cal data because a file for it already exists: {save_path=}")
         else:
             self.lg.debug(f"Not saving cal data because we don't understand its kind: {kind=}")
 
@@ -317,6 +511,10 @@ class Saver(object):
             Arguments parsed to server run command.
         """
 
+        # a new run means we're done with the previous run's data files and problems
+        self.close_files()
+        self.save_issues.clear()
+
         run_folder = payload["args"]["run_name"]
         self.folder = pathlib.Path(run_folder)
 
@@ -399,11 +597,7 @@ class Saver(object):
                     with open(str(save_path), "x", newline="") as csvfile:
                         writer = csv.writer(csvfile)
                         writer.writerow(stuff.keys())  # write the header row
-                        for i, this_slot in enumerate(stuff["slot"]):  # write the data rows
-                            row = []
-                            for key4, val4 in stuff.items():
-                                row.append(val4[i])
-                            writer.writerow(row)
+                        writer.writerows(zip(*stuff.values()))  # columns to data rows
 
                     if (self.ftp_uri) and (self.backup_q):
                         self.backup_q.put(save_path)
@@ -416,13 +610,13 @@ class Saver(object):
 
         # save args
         with open(run_args_path, "x") as f:
-            yaml.dump(payload["args"], f)
+            yaml.dump(payload["args"], f, Dumper=YamlDumper)
         if (self.ftp_uri) and (self.backup_q):
             self.backup_q.put(run_args_path)
 
         # save config
         with open(config_path, "x") as f:
-            yaml.dump(payload["config"], f)
+            yaml.dump(payload["config"], f, Dumper=YamlDumper)
         if (self.ftp_uri) and (self.backup_q):
             self.backup_q.put(config_path)
 
@@ -436,83 +630,245 @@ class Saver(object):
             'ftp://[hostname]/[path]/'.
         """
         if (self.ftp_uri) and (self.backup_q):
+            protocol, address = ftp_uri.split("://")
+            host, dest_path = address.split("/", 1)
+            ftphost = f"{protocol}://{host}"
             while True:
                 self.trigger_backup.wait()  # wait for backup trigger
-                # run has finished so backup all files left in the queue
-                while not self.backup_q.empty():
-                    file_to_send = self.backup_q.get()
-                    if file_to_send.exists():  # handle case when file to backup might have disappeared
-                        try:
-                            self.send_backup_file(file_to_send, ftp_uri)
-                        except Exception as e:
-                            self.lg.debug(e)
-                            self.lg.warning(f"Data backup failure. Retrying...")
-                            self.backup_q.put(file_to_send)  # requeue it for later
-                            time.sleep(61)  # don't spam backup tries
-                    else:
-                        self.lg.warning(f"{file_to_send} does not exist!")
+                # run has finished so backup all files left in the queue, over a few connections at once
+                n_workers = min(self.ftp_workers, self.backup_q.qsize())
+                workers = [threading.Thread(target=self.backup_worker, args=(ftphost, dest_path), daemon=True) for i in range(n_workers)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
 
                 self.lg.debug("FTP backup complete.")
                 self.trigger_backup.clear()  # reset the backup trigger flag
 
-    def send_backup_file(self, source, dest):
-        protocol, address = dest.split("://")
-        host, dest_path = address.split("/", 1)
-        ftphost = f"{protocol}://{host}"
+    def backup_worker(self, ftphost, dest_path):
+        """Upload files from the backup queue over one FTP connection until it's empty.
+
+        Failed uploads are requeued and retried over a fresh connection, which also covers
+        another worker creating the same remote folder at the same moment.
+
+        Parameters
+        ----------
+        ftphost : str
+            FTP server address, e.g. 'ftp://[hostname]'.
+        dest_path : str
+            Remote path for backup, relative to the server root.
+        """
+        retry_delay = 1
+        while not self.backup_q.empty():
+            file_to_send = None
+            try:
+                # one connection for the whole batch, reconnect only after a failure
+                with put_ftp(ftphost) as ftp:
+                    while True:
+                        try:
+                            file_to_send = self.backup_q.get_nowait()
+                        except queue.Empty:
+                            break
+                        if file_to_send.exists():  # handle case when file to backup might have disappeared
+                            self.send_backup_file(file_to_send, ftphost, dest_path, ftp)
+                            retry_delay = 1  # connection is good again
+                        else:
+                            self.lg.warning(f"{file_to_send} does not exist!")
+                        file_to_send = None
+            except Exception as e:
+                self.lg.debug(e)
+                self.lg.warning(f"Data backup failure. Retrying...")
+                if file_to_send is not None:
+                    self.backup_q.put(file_to_send)  # requeue it for later
+                time.sleep(retry_delay)  # don't spam backup tries
+                retry_delay = min(retry_delay * 2, self.max_backup_retry_delay)
+
+    def send_backup_file(self, source, ftphost, dest_path, ftp=None):
+        """Upload one file to the FTP backup location.
+
+        Parameters
+        ----------
+        source : pathlib.Path
+            File to upload.
+        ftphost : str
+            FTP server address, e.g. 'ftp://[hostname]'.
+        dest_path : str
+            Remote path for backup, relative to the server root.
+        ftp : put_ftp
+            Already open FTP connection to use. If None, a connection is made just
+            for this file.
+        """
+        if ftp is None:
+            with put_ftp(ftphost) as ftp:
+                return self.send_backup_file(source, ftphost, dest_path, ftp)
         dest_folder = pathlib.PurePosixPath("/" + dest_path)
         dest_folder = dest_folder / source.parent
-        with put_ftp(ftphost) as ftp:
+        if self.ftp_compress:
+            # upload a compressed copy made in a scratch folder so it keeps the source's name
+            with tempfile.TemporaryDirectory() as tmpd:
+                if "zstandard" in sys.modules:
+                    zpath = pathlib.Path(tmpd) / f"{source.name}.zst"
+                    with open(source, "rb") as fin, open(zpath, "wb") as fout:
+                        zstandard.ZstdCompressor(level=3).copy_stream(fin, fout)
+                else:
+                    zpath = pathlib.Path(tmpd) / f"{source.name}.gz"
+                    with open(source, "rb") as fin, gzip.open(zpath, "wb", compresslevel=6) as fout:
+                        shutil.copyfileobj(fin, fout)
+                with open(zpath, "rb") as fh:
+                    ftp.uploadFile(fh, remote_path=str(dest_folder) + "/")
+        else:
             with open(source, "rb") as fh:
                 ftp.uploadFile(fh, remote_path=str(dest_folder) + "/")
 
     def on_message(self, mqttc, obj, msg):
         """Act on an MQTT msg."""
-        self.save_queue.put_nowait(msg)
+        # only queue up messages we have a handler for
+        topic = msg.topic
+        if (self.parse_topic(topic)[0] in self.topic_handlers) or (topic in self.topic_handlers):
+            # these warnings come back to us as log messages, so only send each once per overload or they'd keep the queue full
+            try:
+                self.save_queue.put_nowait(msg)
+            except queue.Full:
+                # stop reading from the broker until the save thread catches up
+                if not self.save_queue_blocked:
+                    self.save_queue_blocked = True
+                    self.lg.warning("Save queue is full, holding off the broker until there's room")
+                self.save_queue.put(msg)
+
+            queued = self.save_queue.qsize()
+            if self.falling_behind:
+                if queued < self.caught_up_queued:
+                    self.falling_behind = False
+                    self.save_queue_blocked = False
+                    self.lg.debug("Saver has caught up")
+            elif queued >= self.behind_queued:
+                self.falling_behind = True
+                self.lg.warning(f"Saver is falling behind, {queued} of {self.max_queued} queue slots are in use")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse_topic(topic):
+        """Split an MQTT topic into its levels.
+
+        Parameters
+        ----------
+        topic : str
+            MQTT topic.
+
+        Returns
+        -------
+        tuple of str
+            Topic levels.
+        """
+        return tuple(topic.split("/"))
+
+    def handle_data(self, payload, topic_list):
+        """Act on a data msg."""
+        subtopic0 = topic_list[1]
+        if subtopic0 == "raw":
+            self.save_data(payload, "/".join(topic_list[2:]))
+        else:
+            self.lg.debug("Saver not acting on data subtopic: %s", subtopic0)
+
+    def handle_calibration(self, payload, topic_list):
+        """Act on a calibration msg."""
+        subtopic0 = topic_list[1]
+        if subtopic0 == "psu":
+            subtopic1 = topic_list[2]
+        else:
+            subtopic1 = None
+        self.save_calibration(payload, subtopic0, subtopic1)
+
+    def handle_run(self, payload, topic_list):
+        """Act on a run start msg."""
+        if "rundata" in payload:
+            rundata = payload["rundata"]
+            remotedigest = bytes.fromhex(rundata.pop("digest").removeprefix("0x"))
+            jrundatab = json.dumps(rundata).encode()
+            mac = self.run_mac.copy()
+            mac.update(jrundatab)
+            if not hmac.compare_digest(remotedigest, mac.digest()):
+                self.lg.warning(f"Malformed run data.")
+            else:
+                self.save_run_settings(rundata)
+        else:
+            self.save_run_settings(payload)
+
+    def handle_log(self, payload, topic_list):
+        """Act on a log msg."""
+        if payload["msg"] == "Run complete!":
+            # make sure everything is on disk before any backup
+            self.close_files(sync=True)
+            if self.ftp_uri is not None:
+                self.lg.info(f"Saver noticed a run completion. Triggering a backup task.")
+                self.trigger_backup.set()
+
+    def handle_msg(self, msg):
+        """Act on one queued MQTT msg."""
+        try:
+            payload = payload_loads(msg.payload)
+            topic_list = self.parse_topic(msg.topic)
+
+            # whole topic families are keyed by their first level, single topics in full
+            handler = self.topic_handlers.get(topic_list[0])
+            if handler is None:
+                handler = self.topic_handlers.get(msg.topic)
+
+            if handler is None:
+                self.lg.debug("Saver not acting on topic: %s", msg.topic)
+            else:
+                handler(payload, topic_list)
+        except OSError as e:
+            # likely a full or failing disk, so give it a moment rather than spinning through the queue failing
+            # every message. the queue and the broker hold on to what arrives meanwhile.
+            self.report_save_issue(e)
+            time.sleep(self.disk_error_backoff)
+        except Exception as e:
+            self.report_save_issue(e)
+
+    def report_save_issue(self, e, context="Data save issue"):
+        """Log a problem saving data, warning only on its first and every issue_log_interval-th occurrence.
+
+        Parameters
+        ----------
+        e : Exception
+            The problem.
+        context : str
+            What was going on when it came up.
+        """
+        # count repeats of the same problem so a bad publisher or a full disk can't flood the log
+        issue = f"{type(e).__name__}: {e}"
+        self.save_issues[issue] += 1
+        n = self.save_issues[issue]
+        if n == 1:
+            self.lg.warning(f"{context}: {e}")
+        elif n % self.issue_log_interval == 0:
+            self.lg.warning(f"{context}: {e} (seen {n} times)")
+        else:
+            self.lg.debug("%s: %s", context, e)
 
     def save_handler(self):
         """Handle cmds to saver."""
         self.lg.debug(f"Saving to {os.getcwd()}")
+        last_flush = time.monotonic()
         while True:
-            msg = self.save_queue.get()
+            # drain whatever has piled up so it's written out as one batch
+            msgs = [self.save_queue.get()]
+            while len(msgs) < self.max_batch:
+                try:
+                    msgs.append(self.save_queue.get_nowait())
+                except queue.Empty:
+                    break
 
-            try:
-                payload = json.loads(msg.payload.decode())
-                topic_list = msg.topic.split("/")
-                topic = topic_list[0]
-
-                if topic == "data":
-                    subtopic0 = topic_list[1]
-                    if subtopic0 == "raw":
-                        self.save_data(payload, msg.topic.replace("data/raw/", ""))
-                    else:
-                        self.lg.debug(f"Saver not acting on data subtopic: {subtopic0}")
-                elif topic == "calibration":
-                    subtopic0 = topic_list[1]
-                    if subtopic0 == "psu":
-                        subtopic1 = topic_list[2]
-                    else:
-                        subtopic1 = None
-                    self.save_calibration(payload, subtopic0, subtopic1)
-                elif msg.topic == "measurement/run":
-                    if "rundata" in payload:
-                        rundata = payload["rundata"]
-                        remotedigest = bytes.fromhex(rundata.pop("digest").removeprefix("0x"))
-                        jrundatab = json.dumps(rundata).encode()
-                        localdigest = hmac.digest(self.hk, jrundatab, "sha1")
-                        if remotedigest != localdigest:
-                            self.lg.warning(f"Malformed run data.")
-                        else:
-                            self.save_run_settings(rundata)
-                    else:
-                        self.save_run_settings(payload)
-                elif msg.topic == "measurement/log":
-                    if (payload["msg"] == "Run complete!") and (self.ftp_uri is not None):
-                        self.lg.info(f"Saver noticed a run completion. Triggering a backup task.")
-                        self.trigger_backup.set()
-                else:
-                    self.lg.debug(f"Saver not acting on topic: {msg.topic}")
-            except Exception as e:
-                self.lg.warning(f"Data save issue: {e}")
+            for msg in msgs:
+                self.handle_msg(msg)
+
+            # push buffered data out to disk whenever we catch up, or every so often if we can't
+            now = time.monotonic()
+            if self.save_queue.empty() or (now - last_flush > self.flush_interval):
+                self.flush_files()
+                last_flush = now
 
     def mqtt_connector(self, mqttc):
         while True:
@@ -530,7 +886,7 @@ class Saver(object):
         self.mqttc.subscribe("data/#", qos=2)
         self.mqttc.subscribe("calibration/#", qos=2)
         self.mqttc.subscribe("measurement/#", qos=2)
-        self.mqttc.publish("saver/status", json.dumps(f"{self.client_id} ready"), qos=2)
+        self.mqttc.publish("saver/status", payload_dumps(f"{self.client_id} ready"), qos=2)
 
     def on_disconnect(self, client, userdata, rc):
         self.lg.debug(f"{self.client_id} disconnected from broker with result code {rc}")
@@ -549,14 +905,21 @@ class Saver(object):
         # start output relay
         threading.Thread(target=self.out_relay, daemon=True).start()
 
+        # systemd stops us with SIGTERM, so turn that into a normal exit to get open data files closed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
         # start save handler
-        self.save_handler()
+        try:
+            self.save_handler()
+        finally:
+            self.close_files(sync=True)
 
 
 def main():
     parser = argparse.ArgumentParser(description="MQTT Saver")
     parser.add_argument("--mqtt-host", type=str, nargs="?", default="127.0.0.1", const="127.0.0.1", help="IP address or hostname for MQTT broker.")
     parser.add_argument("--ftp-uri", type=str, help="Full FTP server address and remote path for backup, e.g. ftp://[hostname]/[path]/")
+    parser.add_argument("--ftp-compress", action="store_true", help="Upload compressed copies of files to the FTP backup (.zst if zstandard is installed, .gz otherwise).")
 
     args = parser.parse_args()
     ftp_uri_env_var_name = Saver.ftp_env_var
@@ -567,7 +930,7 @@ def main():
     else:
         ftp_uri = None
 
-    s = Saver(mqtt_host=args.mqtt_host, ftp_uri=ftp_uri)
+    s = Saver(mqtt_host=args.mqtt_host, ftp_uri=ftp_uri, ftp_compress=args.ftp_compress)
     s.run()
 
 
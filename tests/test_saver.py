@@ -1,4 +1,11 @@
 import unittest
+import unittest.mock
+import json
+import math
+import os
+import pathlib
+import tempfile
+from types import SimpleNamespace
 
 from saver.saver import Saver
 
@@ -13,6 +20,86 @@ class SaverTestCase(unittest.TestCase):
         s = Saver(mqtt_host=self.mqtt_host)
         self.assertIsInstance(s, Saver)
 
+    def setUp(self):
+        """work in a scratch folder"""
+        tmpd = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpd.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpd.name)
+        self.tmpd = pathlib.Path(tmpd.name)
+
+    def make_saver(self):
+        """a saver set up as if a run had started"""
+        s = Saver(mqtt_host=self.mqtt_host)
+        s.folder = pathlib.Path("run")
+        s.folder.mkdir()
+        s.exp_timestamp = "123"
+        return s
+
+    @staticmethod
+    def pixel(pad=1):
+        """pixel info for a data payload"""
+        return {"slot": "A", "user_label": "", "pad": pad}
+
+    def test_file_cache_limit(self):
+        """data file handle cache stays bounded without losing rows"""
+        s = self.make_saver()
+        s.max_open_files = 2
+        for i in range(3):
+            for pad in range(4):
+                s.save_data({"pixel": self.pixel(pad), "data": [[i, pad]]}, "vt_measurement")
+        self.assertEqual(len(s.file_cache), 2)
+        s.close_files()
+        files = sorted(s.folder.glob("*.vt.tsv"))
+        self.assertEqual(len(files), 4)
+        for f in files:
+            lines = f.read_text().splitlines()
+            self.assertEqual(lines[0], s.iv_header.strip())
+            self.assertEqual(len(lines), 4)
+
+    def test_evict_close_failure(self):
+        """a failure closing an evicted data file doesn't cost the new file its header or row"""
+        s = self.make_saver()
+        s.max_open_files = 1
+        s.save_data({"pixel": self.pixel(1), "data": [[1, 2]]}, "vt_measurement")
+        path, f = s.file_cache[("A_device1", "vt")]
+        f.close = unittest.mock.Mock(side_effect=OSError(28, "No space left on device"))
+        s.save_data({"pixel": self.pixel(2), "data": [[5, 6]]}, "vt_measurement")
+        s.close_files()
+        lines = s.folder.joinpath("A_device2_123.vt.tsv").read_text().splitlines()
+        self.assertEqual(lines, [s.iv_header.strip(), "5\t6"])
+        self.assertEqual(sum(s.save_issues.values()), 1)
+
+    def test_sweep_numbering(self):
+        """liv/div files continue numbering after ones already on disk"""
+        s = self.make_saver()
+        for n in [1, 3]:
+            s.folder.joinpath(f"A_device1_123.liv{n}.tsv").touch()
+        for sweep in ["l", "l", "d"]:
+            s.save_data({"sweep": sweep, "pixel": self.pixel(), "data": [[0.1, 0.2, 0.3, 0]]}, "iv_measurement/1")
+        names = sorted(p.name for p in s.folder.iterdir())
+        self.assertEqual(names, [f"A_device1_123.{e}.tsv" for e in ["div1", "liv1", "liv3", "liv4", "liv5"]])
+
+    def test_bad_sweep_payload(self):
+        """a malformed sweep payload doesn't claim a file"""
+        s = self.make_saver()
+        for data in [5, [[0.1, 0.2, 0.3, 0]]]:
+            try:
+                s.save_data({"sweep": "l", "pixel": self.pixel(), "data": data}, "iv_measurement/1")
+            except TypeError:
+                pass
+        names = sorted(p.name for p in s.folder.iterdir())
+        self.assertEqual(names, ["A_device1_123.liv1.tsv"])
+
+    def test_nan_data(self):
+        """rows holding NaN or Infinity, as written by python's json module, are saved"""
+        s = self.make_saver()
+        payload = json.dumps({"sweep": "l", "pixel": self.pixel(), "data": [[0.1, math.nan, math.inf, 1]]}).encode()
+        s.handle_msg(SimpleNamespace(topic="data/raw/iv_measurement/1", payload=payload))
+        self.assertEqual(len(s.save_issues), 0)
+        lines = s.folder.joinpath("A_device1_123.liv1.tsv").read_text().splitlines()
+        self.assertEqual(lines[1], "0.1\tnan\tinf\t1")
+
     def test_full_run(self):
         """test a full saver run (runs forever)"""
         s = Saver(mqtt_host=self.mqtt_host)